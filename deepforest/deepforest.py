@@ -301,6 +301,8 @@ class deepforest:
         validation_generator = CSVGenerator(
             args.annotations,
             args.classes,
+            batch_size=args.batch_size,
+            group_method="ratio",
             image_min_side=args.image_min_side,
             image_max_side=args.image_max_side,
             config=args.config,
@@ -317,7 +319,10 @@ class deepforest:
                                       color_annotation=color_annotation,
                                       color_detection=color_detection,
                                       thickness_annotate=thickness_annotate,
-                                      thickness_detect=thickness_detect)
+                                      thickness_detect=thickness_detect,
+                                      workers=self.config["workers"],
+                                      use_multiprocessing=self.config["multiprocessing"],
+                                      max_queue_size=self.config["max_queue_size"])
 
         # print evaluation
         total_instances = []
@@ -329,16 +334,21 @@ class deepforest:
             total_instances.append(num_annotations)
             precisions.append(average_precision)
 
-        if sum(total_instances) == 0:
+        present_classes = sum(x > 0 for x in total_instances)
+        if present_classes == 0:
             print('No test instances found.')
-            return
+            return 0.0
 
         print('mAP using the weighted average of precisions among classes: {:.4f}'.format(
             sum([a * b for a, b in zip(total_instances, precisions)]) /
             sum(total_instances)))
 
-        mAP = sum(precisions) / sum(x > 0 for x in total_instances)
+        mAP = sum(precisions) / present_classes
         print('mAP: {:.4f}'.format(mAP))
+
+        if comet_experiment:
+            comet_experiment.log_metrics({"mAP": mAP})
+
         return mAP
 
     def predict_image(self,
@@ -74,6 +74,12 @@ def non_max_suppression(*args, **kwargs):
     return tensorflow.image.non_max_suppression(*args, **kwargs)
 
 
+def combined_non_max_suppression(*args, **kwargs):
+    """ See https://www.tensorflow.org/versions/r1.14/api_docs/python/tf/image/combined_non_max_suppression .
+    """
+    return tensorflow.image.combined_non_max_suppression(*args, **kwargs)
+
+
 def range(*args, **kwargs):
     """ See https://www.tensorflow.org/api_docs/python/tf/range .
     """
@@ -17,6 +17,44 @@ limitations under the License.
 import argparse
 import os
 import sys
+import warnings
+
+# common install locations of tcmalloc
+TCMALLOC_PATHS = [
+    '/usr/lib/x86_64-linux-gnu/libtcmalloc.so.4',
+    '/usr/lib/libtcmalloc.so.4',
+    '/usr/lib64/libtcmalloc.so.4',
+]
+
+
+def preload_tcmalloc():
+    """ Restart the current command with tcmalloc preloaded, if it is installed.
+
+    glibc malloc fragments on the large image arrays allocated during evaluation, tcmalloc's thread caches are faster for this pattern.
+    Nothing happens if a tcmalloc or jemalloc is already preloaded, or if the command was already restarted.
+    """
+    if os.environ.get('_DF_MALLOC_SET') or 'malloc' in os.environ.get('LD_PRELOAD', ''):
+        return
+
+    for path in TCMALLOC_PATHS:
+        if os.path.exists(path):
+            os.environ['LD_PRELOAD']     = ':'.join(filter(None, [os.environ.get('LD_PRELOAD'), path]))
+            os.environ['_DF_MALLOC_SET'] = '1'
+
+            # keep running as a module if started with python -m
+            if __spec__ is not None:
+                argv = [sys.executable, '-m', __spec__.name] + sys.argv[1:]
+            else:
+                argv = [sys.executable] + sys.argv
+            os.execv(sys.executable, argv)
+
+
+# restart before the heavy imports below, so tensorflow is only imported once
+# only when started from the command line, calling main() never restarts the process
+if __name__ == "__main__" and '--no-tcmalloc' not in sys.argv[1:]:
+    preload_tcmalloc()
+
+import numpy as np  # noqa: E402
 
 # Allow relative imports when being executed as script.
 if __name__ == "__main__" and __package__ is None:
@@ -29,13 +67,16 @@ from .. import models
 from ..preprocessing.csv_generator import CSVGenerator
 from ..preprocessing.pascal_voc import PascalVocGenerator
 from ..utils.config import read_config_file, parse_anchor_parameters
-from ..utils.eval import evaluate
+from ..utils.eval import _InferenceSequence, evaluate
+from ..utils.inference import GraphModel, convert_tensorrt, convert_tflite_int8, fold_batch_norms, freeze_model, warmup
 from ..utils.keras_version import check_keras_version
-from ..utils.gpu import setup_gpu
+from ..utils.gpu import setup_session
 
 
 def create_generator(args):
     """ Create generators for evaluation.
+
+    By default images are grouped by aspect ratio so that batches of similar images need little padding.
     """
     if args.dataset_type == 'coco':
         # import here to prevent unnecessary dependency on cocoapi
@@ -44,6 +85,7 @@ def create_generator(args):
         validation_generator = CocoGenerator(
             args.coco_path,
             'val2017',
+            group_method=args.group_method,
             image_min_side=args.image_min_side,
             image_max_side=args.image_max_side,
             config=args.config,
@@ -53,6 +95,8 @@ def create_generator(args):
         validation_generator = PascalVocGenerator(
             args.pascal_path,
             'test',
+            batch_size=args.batch_size,
+            group_method=args.group_method,
             image_min_side=args.image_min_side,
             image_max_side=args.image_max_side,
             config=args.config,
@@ -62,6 +106,10 @@ def create_generator(args):
         validation_generator = CSVGenerator(
             args.annotations,
             args.classes,
+            image_cache_bytes=args.image_cache_bytes,
+            annotations_cache_dir=args.annotations_cache_dir,
+            batch_size=args.batch_size,
+            group_method=args.group_method,
             image_min_side=args.image_min_side,
             image_max_side=args.image_max_side,
             config=args.config,
@@ -94,6 +142,8 @@ def parse_args(args):
     parser.add_argument('--convert-model',    help='Convert the model to an inference model (ie. the input is a training model).', action='store_true')
     parser.add_argument('--backbone',         help='The backbone of the model.', default='resnet50')
     parser.add_argument('--gpu',              help='Id of the GPU to use (as reported by nvidia-smi).')
+    parser.add_argument('--cpu-threads',      help='Number of cores to run on, limits tensorflow threads and pins the process to these cores.', type=int)
+    parser.add_argument('--batch-size',       help='Number of images passed through the network at once (defaults to 8).', default=8, type=int)
     parser.add_argument('--score-threshold',  help='Threshold on score to filter detections with (defaults to 0.05).', default=0.05, type=float)
     parser.add_argument('--iou-threshold',    help='IoU Threshold to count for a positive detection (defaults to 0.5).', default=0.5, type=float)
     parser.add_argument('--max-detections',   help='Max Detections per image (defaults to 100).', default=200, type=int)
@@ -101,6 +151,20 @@ def parse_args(args):
     parser.add_argument('--image-min-side',   help='Rescale the image so the smallest side is min_side.', type=int, default=1000)
     parser.add_argument('--image-max-side',   help='Rescale the image if the largest side is larger than max_side.', type=int, default=1333)
     parser.add_argument('--config',           help='Path to a configuration parameters .ini file (only used with --convert-model).')
+    parser.add_argument('--group-method',     help='How images are grouped into batches, \'ratio\' minimizes padding (defaults to ratio).', choices=['none', 'random', 'ratio'], default='ratio')
+    parser.add_argument('--workers',          help='Number of workers loading images ahead of the network, 0 loads them on the main thread (defaults to 1).', type=int, default=1)
+    parser.add_argument('--multiprocessing',  help='Use processes instead of threads for the loading workers.', action='store_true')
+    parser.add_argument('--max-queue-size',   help='Number of batches loaded ahead of the network (defaults to 10).', type=int, default=10)
+    parser.add_argument('--image-cache-bytes', help='Size in bytes of the cache of decoded images, 0 disables caching (only used for csv without --multiprocessing, defaults to 0).', type=int, default=0)
+    parser.add_argument('--annotations-cache-dir', help='Directory to cache the parsed annotations in, so they are only parsed once (only used for csv).')
+    parser.add_argument('--no-tcmalloc',      help='Don\'t restart with tcmalloc preloaded when it is installed (only checked when run from the command line).', dest='tcmalloc', action='store_false')
+    parser.add_argument('--warmup',           help='Number of times to run the first batch through the network before evaluating (defaults to 2).', type=int, default=2)
+    parser.add_argument('--precision',        help='Floating point precision used for inference, fp16 enables automatic mixed precision (defaults to fp32).', choices=['fp32', 'fp16'], default='fp32')
+    parser.add_argument('--combined-nms',     help='Filter the whole batch with a single batched NMS op (only used with --convert-model).', action='store_true')
+    parser.add_argument('--fold-batch-norms', help='Fold batch normalization into the preceding convolutions before evaluating (ignored with --trt, which fuses them itself).', action='store_true')
+    parser.add_argument('--int8',             help='Quantize the network to int8 with tflite for fast CPU evaluation, the model must be a training model.', action='store_true')
+    parser.add_argument('--trt',              help='Optimize the inference model with TensorRT at FP16 precision (requires a TensorRT enabled tensorflow build).', action='store_true')
+    parser.add_argument('--verbose',          help='Print the model summary and the average precision of every class.', action='store_true')
 
     return parser.parse_args(args)
 
@@ -114,14 +178,16 @@ def main(args=None):
     # make sure keras is the minimum required version
     check_keras_version()
 
-    # optionally choose specific GPU
-    if args.gpu:
-        setup_gpu(args.gpu)
+    # create the first session of the process, optionally on a specific GPU, in half precision and with limited cpu threads
+    session_config = setup_session(gpu_id=args.gpu, mixed_precision=args.precision == 'fp16', cpu_threads=args.cpu_threads)
 
     # make save path if it doesn't exist
     if args.save_path is not None and not os.path.exists(args.save_path):
         os.makedirs(args.save_path)
 
+    if args.image_cache_bytes and args.multiprocessing:
+        warnings.warn('--image-cache-bytes has no effect with --multiprocessing, every worker process fills and discards its own cache.')
+
     # optionally load config parameters
     if args.config:
         args.config = read_config_file(args.config)
@@ -138,12 +204,31 @@ def main(args=None):
     print('Loading model, this may take a second...')
     model = models.load_model(args.model, backbone_name=args.backbone)
 
-    # optionally convert the model
-    if args.convert_model:
-        model = models.convert_model(model, anchor_params=anchor_params)
+    # optionally quantize the network for cpu inference, boxes are still decoded and filtered in float
+    if args.int8:
+        models.check_training_model(model)
+        model = convert_tflite_int8(model, generator, anchor_params=anchor_params)
+    else:
+        # optionally convert the model
+        if args.convert_model:
+            model = models.convert_model(model, anchor_params=anchor_params, combined_nms=args.combined_nms)
+
+        # optionally optimize the model with TensorRT, or fold its batch normalization
+        if args.trt:
+            model = convert_tensorrt(model, precision_mode='FP16', max_batch_size=args.batch_size, config=session_config)
+        elif args.fold_batch_norms:
+            graph_def, input_names, output_names = freeze_model(model, release=True)
+            model = GraphModel(fold_batch_norms(graph_def), input_names, output_names, config=session_config)
 
     # print model summary
-    # print(model.summary())
+    if args.verbose and hasattr(model, 'summary'):
+        model.summary()
+
+    # initialize the session and select kernels before evaluation starts, tflite has nothing to initialize
+    # kernels are selected per input shape, so warm up on the first batch evaluation will run
+    if args.warmup > 0 and generator.size() > 0 and not args.int8:
+        group, _, inputs, _, _ = _InferenceSequence(generator)[0]
+        warmup(model, inputs[:len(group)], steps=args.warmup)
 
     # start evaluation
     if args.dataset_type == 'coco':
@@ -156,25 +241,31 @@ def main(args=None):
             iou_threshold=args.iou_threshold,
             score_threshold=args.score_threshold,
             max_detections=args.max_detections,
-            save_path=args.save_path
+            save_path=args.save_path,
+            workers=args.workers,
+            use_multiprocessing=args.multiprocessing,
+            max_queue_size=args.max_queue_size
         )
 
         # print evaluation
-        total_instances = []
-        precisions = []
-        for label, (average_precision, num_annotations) in average_precisions.items():
-            print('{:.0f} instances of class'.format(num_annotations),
-                  generator.label_to_name(label), 'with average precision: {:.4f}'.format(average_precision))
-            total_instances.append(num_annotations)
-            precisions.append(average_precision)
-
-        if sum(total_instances) == 0:
+        if args.verbose:
+            print('\n'.join('{:.0f} instances of class {} with average precision: {:.4f}'.format(
+                num_annotations, generator.label_to_name(label), average_precision
+            ) for label, (average_precision, num_annotations) in average_precisions.items()))
+
+        # columns are (average precision, number of annotations) per class
+        results         = np.array(list(average_precisions.values()), dtype=np.float64).reshape(-1, 2)
+        precisions      = results[:, 0]
+        total_instances = results[:, 1]
+        present_classes = (total_instances > 0).sum()
+
+        if present_classes == 0:
             print('No test instances found.')
             return
 
-        print('mAP using the weighted average of precisions among classes: {:.4f}'.format(sum([a * b for a, b in zip(total_instances, precisions)]) / sum(total_instances)))
-        print('mAP: {:.4f}'.format(sum(precisions) / sum(x > 0 for x in total_instances)))
-        
+        print('mAP using the weighted average of precisions among classes: {:.4f}'.format((total_instances * precisions).sum() / total_instances.sum()))
+        print('mAP: {:.4f}'.format(precisions.sum() / present_classes))
+
 
 if __name__ == '__main__':
     main()
@@ -82,10 +82,13 @@ class Evaluate(keras.callbacks.Callback):
                       self.generator.label_to_name(label), 'with average precision: {:.4f}'.format(average_precision))
             total_instances.append(num_annotations)
             precisions.append(average_precision)
-        if self.weighted_average:
+        present_classes = sum(x > 0 for x in total_instances)
+        if present_classes == 0:
+            self.mean_ap = 0.0
+        elif self.weighted_average:
             self.mean_ap = sum([a * b for a, b in zip(total_instances, precisions)]) / sum(total_instances)
         else:
-            self.mean_ap = sum(precisions) / sum(x > 0 for x in total_instances)
+            self.mean_ap = sum(precisions) / present_classes
 
         if self.tensorboard:
             import tensorflow as tf
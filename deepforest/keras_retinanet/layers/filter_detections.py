@@ -112,6 +112,54 @@ def filter_detections(
     return [boxes, scores, labels] + other_
 
 
+def combined_filter_detections(
+    boxes,
+    classification,
+    score_threshold = 0.2,
+    max_detections  = 300,
+    nms_threshold   = 0.1
+):
+    """ Filter a batch of detections using a single batched, class specific NMS op.
+
+    This is equivalent to filter_detections with class_specific_filter and nms enabled,
+    but processes all images and classes at once instead of one image at a time.
+
+    Args
+        boxes           : Tensor of shape (batch, num_boxes, 4) containing the boxes in (x1, y1, x2, y2) format.
+        classification  : Tensor of shape (batch, num_boxes, num_classes) containing the classification scores.
+        score_threshold : Threshold used to prefilter the boxes with.
+        max_detections  : Maximum number of detections to keep.
+        nms_threshold   : Threshold for the IoU value to determine when a box should be suppressed.
+
+    Returns
+        A list of [boxes, scores, labels], shaped like the output of filter_detections with a leading batch dimension.
+        In case there are less than max_detections detections, the tensors are padded with -1's.
+    """
+    # combined_non_max_suppression clips boxes to [0, 1], boxes are already clipped to the image
+    # so dividing by the largest coordinate keeps clipping a no-op and leaves the IoU unchanged
+    scale = keras.backend.maximum(keras.backend.max(boxes), 1.0)
+
+    nms_boxes, nms_scores, nms_labels, valid_detections = backend.combined_non_max_suppression(
+        keras.backend.expand_dims(boxes / scale, axis=2),
+        classification,
+        max_output_size_per_class = max_detections,
+        max_total_size            = max_detections,
+        iou_threshold             = nms_threshold,
+        score_threshold           = score_threshold
+    )
+
+    # pad the outputs beyond the number of valid detections with -1's
+    valid  = keras.backend.cast(keras.backend.less(
+        keras.backend.expand_dims(keras.backend.arange(max_detections), axis=0),
+        keras.backend.expand_dims(valid_detections, axis=1)
+    ), keras.backend.floatx())
+    boxes  = nms_boxes * scale * keras.backend.expand_dims(valid, axis=2) + keras.backend.expand_dims(valid - 1, axis=2)
+    scores = nms_scores * valid + (valid - 1)
+    labels = keras.backend.cast(nms_labels * valid + (valid - 1), 'int32')
+
+    return [boxes, scores, labels]
+
+
 class FilterDetections(keras.layers.Layer):
     """ Keras layer for filtering detections using score threshold and NMS.
     """
@@ -124,6 +172,7 @@ class FilterDetections(keras.layers.Layer):
         score_threshold       = 0.2,
         max_detections        = 300,
         parallel_iterations   = 32,
+        combined_nms          = False,
         **kwargs
     ):
         """ Filters detections using score threshold, NMS and selecting the top-k detections.
@@ -135,6 +184,7 @@ class FilterDetections(keras.layers.Layer):
             score_threshold       : Threshold used to prefilter the boxes with.
             max_detections        : Maximum number of detections to keep.
             parallel_iterations   : Number of batch items to process in parallel.
+            combined_nms          : Use a single batched NMS op for the whole batch (only with class specific NMS and no other outputs).
         """
         self.nms                   = nms
         self.class_specific_filter = class_specific_filter
@@ -142,6 +192,7 @@ class FilterDetections(keras.layers.Layer):
         self.score_threshold       = score_threshold
         self.max_detections        = max_detections
         self.parallel_iterations   = parallel_iterations
+        self.combined_nms          = combined_nms
         super(FilterDetections, self).__init__(**kwargs)
 
     def call(self, inputs, **kwargs):
@@ -154,6 +205,16 @@ class FilterDetections(keras.layers.Layer):
         classification = inputs[1]
         other          = inputs[2:]
 
+        # filter the whole batch at once
+        if self.combined_nms and self.nms and self.class_specific_filter and not other:
+            return combined_filter_detections(
+                boxes,
+                classification,
+                score_threshold = self.score_threshold,
+                max_detections  = self.max_detections,
+                nms_threshold   = self.nms_threshold,
+            )
+
         # wrap nms with our parameters
         def _filter_detections(args):
             boxes          = args[0]
@@ -218,6 +279,7 @@ class FilterDetections(keras.layers.Layer):
             'score_threshold'       : self.score_threshold,
             'max_detections'        : self.max_detections,
             'parallel_iterations'   : self.parallel_iterations,
+            'combined_nms'          : self.combined_nms,
         })
 
         return config
@@ -288,6 +288,7 @@ def retinanet_bbox(
     model                 = None,
     nms                   = True,
     class_specific_filter = True,
+    combined_nms          = False,
     name                  = 'retinanet-bbox',
     anchor_params         = None,
     **kwargs
@@ -301,6 +302,7 @@ def retinanet_bbox(
         model                 : RetinaNet model to append bbox layers to. If None, it will create a RetinaNet model using **kwargs.
         nms                   : Whether to use non-maximum suppression for the filtering step.
         class_specific_filter : Whether to use class specific filtering or filter for the best scoring class only.
+        combined_nms          : Whether to filter the whole batch with a single batched NMS op.
         name                  : Name of the model.
         anchor_params         : Struct containing anchor parameters. If None, default values are used.
         *kwargs               : Additional kwargs to pass to the minimal retinanet model.
@@ -345,6 +347,7 @@ def retinanet_bbox(
     detections = layers.FilterDetections(
         nms                   = nms,
         class_specific_filter = class_specific_filter,
+        combined_nms          = combined_nms,
         name                  = 'filtered_detections'
     )([boxes, classification] + other)
 
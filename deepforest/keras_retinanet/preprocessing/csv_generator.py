@@ -23,8 +23,13 @@ from PIL import Image
 from six import raise_from
 
 import csv
+import hashlib
+import pickle
 import sys
 import os.path
+import tempfile
+import threading
+import warnings
 from collections import OrderedDict
 
 
@@ -99,6 +104,66 @@ def _read_annotations(csv_reader, classes):
     return result
 
 
+def _cache_path(cache_dir, csv_data_file, csv_class_file):
+    """ Path of the cached annotations for the given annotations and classes files.
+
+    The name contains a hash of the content of both files, so an edited file never matches a stale cache.
+    """
+    sha1 = hashlib.sha1()
+    for path in (csv_data_file, csv_class_file):
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                sha1.update(chunk)
+    return os.path.join(cache_dir, 'annotations_{}.pkl'.format(sha1.hexdigest()))
+
+
+def _load_cache(path):
+    """ Load cached annotations, returns None if there is no cache or it can't be read.
+    """
+    try:
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def _save_cache(path, image_data):
+    """ Save annotations to the cache.
+
+    The cache is written to a temporary file that replaces the cache at once, so a concurrent run never reads a partial cache.
+    """
+    cache_dir = os.path.dirname(path)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump(image_data, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def _prefetch(path):
+    """ Ask the kernel to start reading a file into the page cache, without waiting for it.
+
+    Errors are ignored, they are raised when the file is actually read.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
 def _open_for_csv(path):
     """ Open a file with flags suitable for csv.reader.
 
@@ -122,6 +187,8 @@ class CSVGenerator(Generator):
         csv_data_file,
         csv_class_file,
         base_dir=None,
+        image_cache_bytes=0,
+        annotations_cache_dir=None,
         **kwargs
     ):
         """ Initialize a CSV data generator.
@@ -130,11 +197,20 @@ class CSVGenerator(Generator):
             csv_data_file: Path to the CSV annotations file.
             csv_class_file: Path to the CSV classes file.
             base_dir: Directory w.r.t. where the files are to be searched (defaults to the directory containing the csv_data_file).
+            image_cache_bytes: Maximum size of the cache of decoded images, 0 disables caching.
+                The cache lives in this process, with multiprocessing workers every worker fills its own copy and throws it away.
+            annotations_cache_dir: Directory to cache the parsed annotations in, so large annotation files are only parsed once (defaults to no caching).
         """
         self.image_names = []
         self.image_data  = {}
         self.base_dir    = base_dir
 
+        # least recently used cache of decoded images, keyed by (path, modification time)
+        self.image_cache_bytes = image_cache_bytes
+        self.image_cache       = OrderedDict()
+        self.image_cache_used  = 0
+        self.image_cache_lock  = threading.Lock()
+
         # Take base_dir from annotations file if not explicitly specified.
         if self.base_dir is None:
             self.base_dir = os.path.dirname(csv_data_file)
@@ -150,12 +226,27 @@ class CSVGenerator(Generator):
         for key, value in self.classes.items():
             self.labels[value] = key
 
-        # csv with img_path, x1, y1, x2, y2, class_name
-        try:
-            with _open_for_csv(csv_data_file) as file:
-                self.image_data = _read_annotations(csv.reader(file, delimiter=','), self.classes)
-        except ValueError as e:
-            raise_from(ValueError('invalid CSV annotations file: {}: {}'.format(csv_data_file, e)), None)
+        # optionally reuse annotations parsed by an earlier run
+        cache_path = None
+        self.image_data = None
+        if annotations_cache_dir is not None:
+            cache_path      = _cache_path(annotations_cache_dir, csv_data_file, csv_class_file)
+            self.image_data = _load_cache(cache_path)
+
+        if self.image_data is None:
+            # csv with img_path, x1, y1, x2, y2, class_name
+            try:
+                with _open_for_csv(csv_data_file) as file:
+                    self.image_data = _read_annotations(csv.reader(file, delimiter=','), self.classes)
+            except ValueError as e:
+                raise_from(ValueError('invalid CSV annotations file: {}: {}'.format(csv_data_file, e)), None)
+
+            # the annotations are parsed already, a cache that can't be written only costs the next run
+            if cache_path is not None:
+                try:
+                    _save_cache(cache_path, self.image_data)
+                except OSError as e:
+                    warnings.warn('Could not cache annotations in {}: {}'.format(annotations_cache_dir, e))
         self.image_names = list(self.image_data.keys())
 
         super(CSVGenerator, self).__init__(**kwargs)
@@ -202,10 +293,64 @@ class CSVGenerator(Generator):
         image = Image.open(self.image_path(image_index))
         return float(image.width) / float(image.height)
 
+    def image_cached(self, path):
+        """ Returns True if the decoded image at path is in the image cache and still up to date.
+        """
+        if not self.image_cache_bytes:
+            return False
+
+        try:
+            key = (path, os.path.getmtime(path))
+        except OSError:
+            return False
+
+        with self.image_cache_lock:
+            return key in self.image_cache
+
     def load_image(self, image_index):
         """ Load an image at the image_index.
+
+        If image_cache_bytes is set, decoded images are cached and a copy of the cached image is returned.
         """
-        return read_image_bgr(self.image_path(image_index))
+        path = self.image_path(image_index)
+        if not self.image_cache_bytes:
+            return read_image_bgr(path)
+
+        key = (path, os.path.getmtime(path))
+        with self.image_cache_lock:
+            image = self.image_cache.get(key)
+            if image is not None:
+                self.image_cache.move_to_end(key)
+                return image.copy()
+
+        image = read_image_bgr(path)
+        if image.nbytes > self.image_cache_bytes:
+            return image
+
+        with self.image_cache_lock:
+            if key not in self.image_cache:
+                self.image_cache[key]  = image
+                self.image_cache_used += image.nbytes
+
+            # evict the least recently used images
+            while self.image_cache_used > self.image_cache_bytes:
+                _, evicted = self.image_cache.popitem(last=False)
+                self.image_cache_used -= evicted.nbytes
+
+        return image.copy()
+
+    def load_image_group(self, group):
+        """ Load images for all images in a group.
+
+        The files of the whole group are prefetched first, so reading the next files overlaps with decoding.
+        Images in the decoded image cache are not read, so they are not prefetched.
+        """
+        for image_index in group:
+            path = self.image_path(image_index)
+            if not self.image_cached(path):
+                _prefetch(path)
+
+        return super(CSVGenerator, self).load_image_group(group)
 
     def load_annotations(self, image_index):
         """ Load annotations for an image_index.
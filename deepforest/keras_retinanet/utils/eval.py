@@ -15,11 +15,14 @@ limitations under the License.
 """
 
 from .anchors import compute_overlap
+from .image import CAFFE_MEAN, preprocess_image
 from .visualization import draw_detections, draw_annotations
 
 import keras
 import numpy as np
 import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import progressbar
@@ -42,9 +45,8 @@ def _compute_ap(recall, precision):
     mrec = np.concatenate(([0.], recall, [1.]))
     mpre = np.concatenate(([0.], precision, [0.]))
 
-    # compute the precision envelope
-    for i in range(mpre.size - 1, 0, -1):
-        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+    # compute the precision envelope, a running maximum from the end of the curve
+    mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
     # to calculate area under PR curve, look for points
     # where X axis (recall) changes value
@@ -55,76 +57,223 @@ def _compute_ap(recall, precision):
     return ap
 
 
-def _get_detections(generator, model, score_threshold=0.05, max_detections=100, save_path=None, comet_experiment=None, color_annotation=(0,0,0), color_detection=None, thickness_annotate=1, thickness_detect=1):
+class _InferenceSequence(keras.utils.Sequence):
+    """ Sequence of network inputs for evaluation, one batch per group of the generator.
+
+    Each item is a tuple (group, raw_images, inputs, scales, shapes), where shapes are the (rows, cols) of the resized
+    images, so that loading and preprocessing can run ahead of the network in a keras.utils.OrderedEnqueuer.
+
+    # Arguments
+        generator : The generator used to load and preprocess the images.
+    """
+    def __init__(self, generator):
+        self.generator = generator
+
+        # the last group wraps around to the start of the dataset, only run each image once
+        self.groups = []
+        processed   = set()
+        for group in generator.groups:
+            group = [i for i in group if i not in processed]
+            processed.update(group)
+            self.groups.append(group)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def _fused_inputs(self, raw_images):
+        """ Resize the images straight into the padded batch, subtracting the ImageNet mean while copying.
+
+        Resizing is linear, so subtracting the mean afterwards gives the same inputs as preprocessing first,
+        without a preprocessed copy of every full size image.
+        """
+        resized = []
+        scales  = []
+        for image in raw_images:
+            image, scale = self.generator.resize_image(image.astype(np.float32))
+            resized.append(image)
+            scales.append(scale)
+
+        max_shape = tuple(max(image.shape[x] for image in resized) for x in range(3))
+        inputs    = np.zeros((len(resized),) + max_shape, dtype=keras.backend.floatx())
+        for index, image in enumerate(resized):
+            np.subtract(image, CAFFE_MEAN, out=inputs[index, :image.shape[0], :image.shape[1], :])
+
+        return inputs, scales, [image.shape[:2] for image in resized]
+
+    def __getitem__(self, index):
+        group      = self.groups[index]
+        raw_images = self.generator.load_image_group(group)
+
+        # the default preprocessing only subtracts the mean, which can be fused with resizing and padding
+        if self.generator.preprocess_image is preprocess_image and keras.backend.image_data_format() == 'channels_last':
+            inputs, scales, shapes = self._fused_inputs(raw_images)
+            return group, raw_images, inputs, scales, shapes
+
+        # images of the same shape are preprocessed as a single array instead of one at a time
+        if len(set(image.shape for image in raw_images)) == 1:
+            image_group = list(self.generator.preprocess_image(np.stack(raw_images)))
+        else:
+            image_group = [self.generator.preprocess_image(image.copy()) for image in raw_images]
+
+        scales = []
+        for index, image in enumerate(image_group):
+            image_group[index], scale = self.generator.resize_image(image)
+            scales.append(scale)
+
+        # images are padded to the largest shape in the group
+        inputs = self.generator.compute_inputs(image_group)
+
+        return group, raw_images, inputs, scales, [image.shape[:2] for image in image_group]
+
+
+def _get_detections(generator, model, score_threshold=0.05, max_detections=100, save_path=None, comet_experiment=None, color_annotation=(0,0,0), color_detection=None, thickness_annotate=1, thickness_detect=1, workers=1, use_multiprocessing=False, max_queue_size=10):
     """ Get the detections from the model using the generator.
 
     The result is a list of lists such that the size is:
         all_detections[num_images][num_classes] = detections[num_detections, 4 + num_classes]
 
+    Images are passed through the model one group at a time, following generator.groups,
+    so the batch size of the generator sets the inference batch size.
+
     # Arguments
-        generator         : The generator used to run images through the model.
-        model             : The model to run on the images.
-        score_threshold   : The score confidence threshold to use.
-        max_detections    : The maximum number of detections to use per image.
-        save_path         : The path to save the images with visualized detections to.
-        color_annotation  : The color used for manual annotation, by default is black.
-        color_detection   : The color used for model prediction label, by default the color from keras_retinanet.utils.colors.label_color will be used.
-        thickness_annotate: The thickness of the lines to draw a annotation box with.
-        thickness_detect  : The thickness of the lines to draw a detection box with.
+        generator           : The generator used to run images through the model.
+        model               : The model to run on the images.
+        score_threshold     : The score confidence threshold to use.
+        max_detections      : The maximum number of detections to use per image.
+        save_path           : The path to save the images with visualized detections to.
+        color_annotation    : The color used for manual annotation, by default is black.
+        color_detection     : The color used for model prediction label, by default the color from keras_retinanet.utils.colors.label_color will be used.
+        thickness_annotate  : The thickness of the lines to draw a annotation box with.
+        thickness_detect    : The thickness of the lines to draw a detection box with.
+        workers             : Number of workers loading batches ahead of the network, 0 loads them on the main thread.
+        use_multiprocessing : If True, use process based workers instead of threads.
+        max_queue_size      : Maximum number of batches loaded ahead of the network.
     # Returns
         A list of lists containing the detections for each image in the generator.
     """
     all_detections = [[None for i in range(generator.num_classes()) if generator.has_label(i)] for j in range(generator.size())]
 
-    for i in progressbar.progressbar(range(generator.size()), prefix='Running network: '):
-        raw_image    = generator.load_image(i)
-        image        = generator.preprocess_image(raw_image.copy())
-        image, scale = generator.resize_image(image)
+    # images with visualized detections are encoded and written in the background, overlapping with inference
+    write_workers = 4
+    writer        = ThreadPoolExecutor(max_workers=write_workers) if save_path is not None else None
+    writes        = []
+    waited        = 0
+
+    sequence = _InferenceSequence(generator)
+    enqueuer = None
+    if workers > 0:
+        enqueuer = keras.utils.OrderedEnqueuer(sequence, use_multiprocessing=use_multiprocessing, shuffle=False)
+        enqueuer.start(workers=workers, max_queue_size=max_queue_size)
+        batches = enqueuer.get()
+    else:
+        batches = (sequence[index] for index in range(len(sequence)))
+
+    try:
+        for _ in progressbar.progressbar(range(len(sequence)), prefix='Running network: '):
+            group, raw_images, inputs, scales, shapes = next(batches)
+
+            # run network on the whole group at once, the last group can be smaller than the batch
+            batch_boxes, batch_scores, batch_labels = model.predict_on_batch(inputs[:len(group)])[:3]
+
+            for batch_index, i in enumerate(group):
+                raw_image = raw_images[batch_index]
+
+                # the network clips boxes to the padded batch, clip them to the image itself
+                rows, cols = shapes[batch_index]
+                boxes      = batch_boxes[batch_index].copy()
+                boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, cols)
+                boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, rows)
+
+                # correct boxes for image scale
+                boxes /= scales[batch_index]
+                scores = batch_scores[batch_index]
+                labels = batch_labels[batch_index]
+
+                # select indices which have a score above the threshold
+                indices = np.where(scores > score_threshold)[0]
+
+                # select those scores
+                scores = scores[indices]
+
+                # find the order with which to sort the scores
+                scores_sort = np.argsort(-scores)[:max_detections]
+
+                # select detections
+                image_boxes      = boxes[indices[scores_sort], :]
+                image_scores     = scores[scores_sort]
+                image_labels     = labels[indices[scores_sort]]
+                image_detections = np.concatenate([image_boxes, np.expand_dims(image_scores, axis=1), np.expand_dims(image_labels, axis=1)], axis=1)
+
+                if save_path is not None:
+                    draw_annotations(raw_image, generator.load_annotations(i),color=color_annotation, label_to_name=generator.label_to_name,thickness=thickness_annotate)
+                    draw_detections(raw_image, image_boxes, image_scores, image_labels, color=color_detection, label_to_name=generator.label_to_name, score_threshold=score_threshold, thickness=thickness_detect)
+
+                    image_path = os.path.join(save_path, '{}.png'.format(i))
+                    writes.append((i, image_path, writer.submit(cv2.imwrite, image_path, raw_image)))
+
+                    # every pending write holds a full size image, wait for the oldest when writing falls behind
+                    while len(writes) - waited > 2 * write_workers:
+                        writes[waited][2].result()
+                        waited += 1
+
+                # copy detections to all_detections
+                for label in range(generator.num_classes()):
+                    if not generator.has_label(label):
+                        continue
+
+                    all_detections[i][label] = image_detections[image_detections[:, -1] == label, :-1]
+    finally:
+        if enqueuer is not None:
+            enqueuer.stop()
+        if writer is not None:
+            writer.shutdown(wait=True)
+
+    # errors while writing are raised here, images that could not be written are not logged
+    written_paths = []
+    for i, image_path, write in writes:
+        if write.result():
+            written_paths.append((i, image_path))
+        else:
+            warnings.warn('Could not write image with detections to {}.'.format(image_path))
+
+    #Log images, once they are all written
+    if comet_experiment:
+        for i, image_path in written_paths:
+            comet_experiment.log_image(image_path, generator.image_names[i])
 
-        if keras.backend.image_data_format() == 'channels_first':
-            image = image.transpose((2, 0, 1))
-
-        # run network
-        boxes, scores, labels = model.predict_on_batch(np.expand_dims(image, axis=0))[:3]
-
-        # correct boxes for image scale
-        boxes /= scale
-
-        # select indices which have a score above the threshold
-        indices = np.where(scores[0, :] > score_threshold)[0]
+    return all_detections
 
-        # select those scores
-        scores = scores[0][indices]
 
-        # find the order with which to sort the scores
-        scores_sort = np.argsort(-scores)[:max_detections]
+def _match_detections(detections, annotations, iou_threshold):
+    """ Mark the detections of a single image and class that are true positives.
 
-        # select detections
-        image_boxes      = boxes[0, indices[scores_sort], :]
-        image_scores     = scores[scores_sort]
-        image_labels     = labels[0, indices[scores_sort]]
-        image_detections = np.concatenate([image_boxes, np.expand_dims(image_scores, axis=1), np.expand_dims(image_labels, axis=1)], axis=1)
+    Detections are matched greedily in the order they are given, each to the annotation it overlaps most.
+    A detection is a true positive if that overlap is at least iou_threshold and the annotation was not detected before.
 
-        if save_path is not None:
-            draw_annotations(raw_image, generator.load_annotations(i),color=color_annotation, label_to_name=generator.label_to_name,thickness=thickness_annotate)
-            draw_detections(raw_image, image_boxes, image_scores, image_labels, color=color_detection, label_to_name=generator.label_to_name, score_threshold=score_threshold, thickness=thickness_detect)
-            
-            image_path = os.path.join(save_path, '{}.png'.format(i))
-            cv2.imwrite(image_path, raw_image)
-            
-            #Log image
-            if comet_experiment:
-                image_name = generator.image_names[i]                        
-                comet_experiment.log_image(image_path, image_name)
+    # Arguments
+        detections    : The detections, a numpy array of shape (N, 4 + ...) of boxes (x1, y1, x2, y2) sorted by score.
+        annotations   : The annotations, a numpy array of shape (K, 4) of boxes (x1, y1, x2, y2).
+        iou_threshold : The threshold used to consider when a detection is positive or negative.
+    # Returns
+        A numpy array of shape (N,), 1 for true positives and 0 for false positives.
+    """
+    true_positives = np.zeros((detections.shape[0],))
+    if annotations.shape[0] == 0 or detections.shape[0] == 0:
+        return true_positives
 
-        # copy detections to all_detections
-        for label in range(generator.num_classes()):
-            if not generator.has_label(label):
-                continue
+    # overlap of every detection with every annotation in a single call
+    overlaps             = compute_overlap(detections[:, :4].astype(np.float64), annotations[:, :4].astype(np.float64))
+    assigned_annotations = np.argmax(overlaps, axis=1)
+    max_overlaps         = overlaps[np.arange(detections.shape[0]), assigned_annotations]
 
-            all_detections[i][label] = image_detections[image_detections[:, -1] == label, :-1]
+    # greedy matching in detection order, each annotation can only be detected once
+    detected_annotations = set()
+    for index in np.where(max_overlaps >= iou_threshold)[0]:
+        if assigned_annotations[index] not in detected_annotations:
+            true_positives[index] = 1
+            detected_annotations.add(assigned_annotations[index])
 
-    return all_detections
+    return true_positives
 
 
 def _get_annotations(generator):
@@ -165,28 +314,35 @@ def evaluate(
     color_annotation=(0,0,0),
     color_detection=None,
     thickness_annotate=1,
-    thickness_detect=1
+    thickness_detect=1,
+    workers=1,
+    use_multiprocessing=False,
+    max_queue_size=10
 ):
     """ Evaluate a given dataset using a given model.
 
     # Arguments
-        generator         : The generator that represents the dataset to evaluate.
-        model             : The model to evaluate.
-        iou_threshold     : The threshold used to consider when a detection is positive or negative.
-        score_threshold   : The score confidence threshold to use for detections.
-        max_detections    : The maximum number of detections to use per image.
-        save_path         : The path to save images with visualized detections to.
-        comet_experiment  : A cometml object to log images
-        color_annotation  : The color used for manual annotation, by default is black.
-        color_detection   : The color used for model prediction label, by default the color from keras_retinanet.utils.colors.label_color will be used.
-        thickness_annotate: The thickness of the lines to draw a annotation box with.
-        thickness_detect  : The thickness of the lines to draw a detection box with.
+        generator           : The generator that represents the dataset to evaluate.
+        model               : The model to evaluate.
+        iou_threshold       : The threshold used to consider when a detection is positive or negative.
+        score_threshold     : The score confidence threshold to use for detections.
+        max_detections      : The maximum number of detections to use per image.
+        save_path           : The path to save images with visualized detections to.
+        comet_experiment    : A cometml object to log images
+        color_annotation    : The color used for manual annotation, by default is black.
+        color_detection     : The color used for model prediction label, by default the color from keras_retinanet.utils.colors.label_color will be used.
+        thickness_annotate  : The thickness of the lines to draw a annotation box with.
+        thickness_detect    : The thickness of the lines to draw a detection box with.
+        workers             : Number of workers loading batches ahead of the network, 0 loads them on the main thread.
+        use_multiprocessing : If True, use process based workers instead of threads.
+        max_queue_size      : Maximum number of batches loaded ahead of the network.
     # Returns
         A dict mapping class names to mAP scores.
     """
     # gather all detections and annotations
     all_detections     = _get_detections(generator, model, score_threshold=score_threshold, max_detections=max_detections, save_path=save_path, comet_experiment=comet_experiment, 
-                                                           color_annotation=color_annotation, color_detection=color_detection, thickness_annotate=thickness_annotate, thickness_detect=thickness_detect)
+                                                           color_annotation=color_annotation, color_detection=color_detection, thickness_annotate=thickness_annotate, thickness_detect=thickness_detect,
+                                                           workers=workers, use_multiprocessing=use_multiprocessing, max_queue_size=max_queue_size)
     all_annotations    = _get_annotations(generator)
     average_precisions = {}
 
@@ -200,36 +356,24 @@ def evaluate(
         if not generator.has_label(label):
             continue
 
-        false_positives = np.zeros((0,))
-        true_positives  = np.zeros((0,))
-        scores          = np.zeros((0,))
+        false_positives = [np.zeros((0,))]
+        true_positives  = [np.zeros((0,))]
+        scores          = [np.zeros((0,))]
         num_annotations = 0.0
 
         for i in range(generator.size()):
             detections           = all_detections[i][label]
             annotations          = all_annotations[i][label]
             num_annotations     += annotations.shape[0]
-            detected_annotations = []
-
-            for d in detections:
-                scores = np.append(scores, d[4])
-
-                if annotations.shape[0] == 0:
-                    false_positives = np.append(false_positives, 1)
-                    true_positives  = np.append(true_positives, 0)
-                    continue
+            image_true_positives = _match_detections(detections, annotations, iou_threshold)
 
-                overlaps            = compute_overlap(np.expand_dims(d, axis=0), annotations)
-                assigned_annotation = np.argmax(overlaps, axis=1)
-                max_overlap         = overlaps[0, assigned_annotation]
+            scores.append(detections[:, 4])
+            true_positives.append(image_true_positives)
+            false_positives.append(1 - image_true_positives)
 
-                if max_overlap >= iou_threshold and assigned_annotation not in detected_annotations:
-                    false_positives = np.append(false_positives, 0)
-                    true_positives  = np.append(true_positives, 1)
-                    detected_annotations.append(assigned_annotation)
-                else:
-                    false_positives = np.append(false_positives, 1)
-                    true_positives  = np.append(true_positives, 0)
+        false_positives = np.concatenate(false_positives)
+        true_positives  = np.concatenate(true_positives)
+        scores          = np.concatenate(scores)
 
         # no annotations -> AP for this class is 0 (is this correct?)
         if num_annotations == 0:
@@ -249,12 +393,14 @@ def evaluate(
         recall    = true_positives / num_annotations
         precision = true_positives / np.maximum(true_positives + false_positives, np.finfo(np.float64).eps)
         
-        #log recall and precision
+        #log recall and precision, in a single request each
         if comet_experiment:
             print("Logging Recall at score threshold {}".format(score_threshold))
-            comet_experiment.log_parameter("score_threshold", score_threshold)
-            comet_experiment.log_metric("IoU_Recall", recall[-1])
-            comet_experiment.log_metric("IoU_Precision", precision[-1])
+            comet_experiment.log_parameters({"score_threshold": score_threshold, "batch_size": generator.batch_size})
+            comet_experiment.log_metrics({
+                "IoU_Recall": recall[-1] if recall.size else 0.0,
+                "IoU_Precision": precision[-1] if precision.size else 0.0,
+            })
 
         # compute average precision
         average_precision  = _compute_ap(recall, precision)
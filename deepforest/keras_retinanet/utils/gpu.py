@@ -14,6 +14,9 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import os
+
+import keras
 import tensorflow as tf
 
 from .tf_version import tf_version_ok
@@ -42,7 +45,6 @@ def setup_gpu(gpu_id):
             logical_gpus = tf.config.experimental.list_logical_devices('GPU')
             print(len(gpus), "Physical GPUs,", len(logical_gpus), "Logical GPUs")
     else:
-        import os
         if gpu_id == 'cpu' or gpu_id == -1:
             os.environ['CUDA_VISIBLE_DEVICES'] = ""
             return
@@ -51,3 +53,67 @@ def setup_gpu(gpu_id):
         config = tf.ConfigProto()
         config.gpu_options.allow_growth = True
         tf.keras.backend.set_session(tf.Session(config=config))
+
+
+def session_config(mixed_precision=False, cpu_threads=None):
+    """ Build the configuration for the tensorflow sessions of a process.
+
+    Args
+        mixed_precision : If True, enable automatic mixed precision. The graph is rewritten so that ops which are
+                          numerically safe in float16 (convolutions, matmuls) run in float16 on Tensor Cores,
+                          while the rest of the graph stays in float32.
+        cpu_threads     : If set, limit the number of threads used within an op.
+
+    Returns
+        A tf.ConfigProto with memory growth enabled.
+    """
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    if mixed_precision:
+        config.graph_options.rewrite_options.auto_mixed_precision = 1
+    if cpu_threads:
+        config.intra_op_parallelism_threads = cpu_threads
+        config.inter_op_parallelism_threads = 2
+    return config
+
+
+def setup_session(gpu_id=None, mixed_precision=False, cpu_threads=None):
+    """ Configure the devices, threads and the tensorflow session used by (standalone) keras.
+
+    This has to be called before any other session is created. In tensorflow 1 the first session of a process
+    creates the thread pools that all later sessions share, so their size and cpu affinity are fixed from then on.
+
+    Args
+        gpu_id          : Id of the GPU to use (as reported by nvidia-smi), 'cpu' or -1 to hide all GPUs.
+        mixed_precision : If True, enable automatic mixed precision, see session_config. The rewrite option is set on the
+                          keras session and on the returned config, the environment variable also covers sessions
+                          created without this config.
+        cpu_threads     : If set, limit the number of threads used within an op and pin the process
+                          to that many cores, so preprocessing and inference threads don't migrate between cores.
+
+    Returns
+        The tf.ConfigProto of the keras session, to be reused for other sessions (None for tensorflow 2).
+    """
+    # for sessions created elsewhere, the sessions created from session_config enable the rewrite themselves
+    if mixed_precision:
+        os.environ['TF_ENABLE_AUTO_MIXED_PRECISION'] = '1'
+
+    # pin before tensorflow creates its thread pools, threads inherit the affinity of the thread creating them
+    # cpu affinity is only supported on linux
+    if cpu_threads and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, sorted(os.sched_getaffinity(0))[:cpu_threads])
+
+    if tf_version_ok((2, 0, 0)):
+        if cpu_threads:
+            tf.config.threading.set_intra_op_parallelism_threads(cpu_threads)
+            tf.config.threading.set_inter_op_parallelism_threads(2)
+        if gpu_id is not None:
+            setup_gpu(gpu_id)
+        return None
+
+    if gpu_id is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = '' if gpu_id == 'cpu' or gpu_id == -1 else str(gpu_id)
+
+    config = session_config(mixed_precision=mixed_precision, cpu_threads=cpu_threads)
+    keras.backend.set_session(tf.Session(config=config))
+    return config
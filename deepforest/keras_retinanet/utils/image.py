@@ -33,6 +33,10 @@ def read_image_bgr(path):
     return image[:, :, ::-1].copy()
 
 
+# ImageNet mean in BGR order, subtracted by the 'caffe' preprocessing mode
+CAFFE_MEAN = np.array([103.939, 116.779, 123.68], dtype=np.float32)
+
+
 def preprocess_image(x, mode='caffe'):
     """ Preprocess an image by subtracting the ImageNet mean.
 
@@ -56,9 +60,7 @@ def preprocess_image(x, mode='caffe'):
         x /= 127.5
         x -= 1.
     elif mode == 'caffe':
-        x[..., 0] -= 103.939
-        x[..., 1] -= 116.779
-        x[..., 2] -= 123.68
+        x -= CAFFE_MEAN
 
     return x
 
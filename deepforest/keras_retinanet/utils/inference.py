@@ -0,0 +1,334 @@
+"""
+Copyright 2017-2018 Fizyr (https://fizyr.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+
+import keras
+import numpy as np
+import tensorflow as tf
+
+from .. import layers
+from .anchors import anchors_for_shape
+from .gpu import session_config
+from .image import compute_resize_scale
+
+
+def freeze_model(model, release=False):
+    """ Freeze the variables of a keras model into constants.
+
+    Args
+        model   : The keras model to freeze.
+        release : If True, close the keras session once the graph is frozen, freeing the memory of the variables.
+                  The keras model can't be used afterwards.
+
+    Returns
+        A tuple (graph_def, input_names, output_names) describing the frozen graph.
+    """
+    session      = keras.backend.get_session()
+    input_names  = [tensor.op.name for tensor in model.inputs]
+    output_names = [tensor.op.name for tensor in model.outputs]
+    graph_def    = tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), output_names)
+
+    if release:
+        keras.backend.clear_session()
+        session.close()
+
+    return graph_def, input_names, output_names
+
+
+def _node_name(name):
+    """ Strip the control dependency prefix and output index from a node input name.
+    """
+    return name.lstrip('^').split(':')[0]
+
+
+def _resolve_const(node_map, name):
+    """ Follow Identity nodes starting at name, returns the Const node they lead to or None.
+    """
+    node = node_map[_node_name(name)]
+    while node.op == 'Identity':
+        node = node_map[_node_name(node.input[0])]
+    return node if node.op == 'Const' else None
+
+
+def fold_batch_norms(graph_def):
+    """ Fold inference mode batch normalization into the preceding convolution.
+
+    Every FusedBatchNorm that directly follows a Conv2D with constant weights is replaced by a BiasAdd,
+    and its scale is multiplied into the convolution weights. This removes a full pass over the
+    activations for every convolution in the backbone, without changing the output.
+
+    Args
+        graph_def: A frozen graph definition, see freeze_model.
+
+    Returns
+        A new graph definition with the batch normalization folded.
+    """
+    node_map  = {node.name: node for node in graph_def.node}
+    consumers = collections.Counter(_node_name(name) for node in graph_def.node for name in node.input)
+
+    # batch norms with consumers of their other outputs (batch mean, variance, ...) can not be replaced
+    extra_outputs = set(_node_name(name) for node in graph_def.node for name in node.input if ':' in name and not name.endswith(':0'))
+
+    replacements = {}
+    for node in graph_def.node:
+        if node.op not in ('FusedBatchNorm', 'FusedBatchNormV2', 'FusedBatchNormV3') or node.attr['is_training'].b:
+            continue
+        if node.attr['data_format'].s != b'NHWC' or node.name in extra_outputs:
+            continue
+
+        conv = node_map[_node_name(node.input[0])]
+        if conv.op != 'Conv2D' or consumers[conv.name] != 1:
+            continue
+
+        constants = [_resolve_const(node_map, name) for name in [conv.input[1]] + list(node.input[1:5])]
+        if any(constant is None for constant in constants):
+            continue
+
+        weights, gamma, beta, mean, variance = [tf.make_ndarray(constant.attr['value'].tensor) for constant in constants]
+        scale = gamma / np.sqrt(variance + node.attr['epsilon'].f)
+
+        folded_weights = tf.NodeDef(name=conv.name + '/folded_weights', op='Const')
+        folded_weights.attr['dtype'].CopyFrom(conv.attr['T'])
+        folded_weights.attr['value'].tensor.CopyFrom(tf.make_tensor_proto((weights * scale).astype(weights.dtype)))
+
+        folded_bias = tf.NodeDef(name=conv.name + '/folded_bias', op='Const')
+        folded_bias.attr['dtype'].CopyFrom(conv.attr['T'])
+        folded_bias.attr['value'].tensor.CopyFrom(tf.make_tensor_proto((beta - mean * scale).astype(weights.dtype)))
+
+        folded_conv = tf.NodeDef()
+        folded_conv.CopyFrom(conv)
+        folded_conv.input[1] = folded_weights.name
+
+        # keep the name of the batch norm, so its consumers don't need to change
+        bias_add = tf.NodeDef(name=node.name, op='BiasAdd', input=[conv.name, folded_bias.name])
+        bias_add.attr['T'].CopyFrom(conv.attr['T'])
+        bias_add.attr['data_format'].s = b'NHWC'
+
+        replacements[conv.name] = [folded_weights, folded_conv]
+        replacements[node.name] = [folded_bias, bias_add]
+
+    output = tf.GraphDef()
+    output.versions.CopyFrom(graph_def.versions)
+    output.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if node.name in replacements:
+            output.node.extend(replacements[node.name])
+        else:
+            output.node.extend([node])
+
+    return output
+
+
+class GraphModel:
+    """ Run a frozen graph in its own session, in place of a keras model for prediction.
+
+    Only predict_on_batch is provided, which is all that is needed by utils.eval.evaluate.
+
+    Args
+        graph_def    : The frozen graph definition.
+        input_names  : Names of the input operations of the graph.
+        output_names : Names of the output operations of the graph.
+        config       : Optional tf.ConfigProto for the session running the graph.
+    """
+    def __init__(self, graph_def, input_names, output_names, config=None):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+
+        self.inputs  = [self.graph.get_tensor_by_name(name + ':0') for name in input_names]
+        self.outputs = [self.graph.get_tensor_by_name(name + ':0') for name in output_names]
+        self.session = tf.Session(graph=self.graph, config=config)
+
+    def predict_on_batch(self, x):
+        """ Run the graph on a single batch of images, returns a list of numpy arrays.
+        """
+        return self.session.run(self.outputs, feed_dict={self.inputs[0]: x})
+
+
+def convert_tensorrt(model, precision_mode='FP16', max_batch_size=1, config=None):
+    """ Convert an inference model to a TensorRT optimized graph.
+
+    TensorRT fuses convolution, batch normalization and activation layers and selects the fastest kernels
+    for the current GPU. Engines are built lazily on the first batch of each input shape, and need free GPU memory
+    to be built, otherwise TensorRT silently falls back to tensorflow. The keras session is closed once the model
+    is frozen to free its memory, so the keras model can't be used afterwards.
+
+    Args
+        model          : The (converted) keras inference model.
+        precision_mode : One of 'FP32', 'FP16' or 'INT8'.
+        max_batch_size : The maximum batch size the engines will be built for.
+        config         : Optional tf.ConfigProto for the session running the optimized graph, should enable memory growth
+                         (defaults to utils.gpu.session_config()).
+
+    Returns
+        A GraphModel running the optimized graph.
+    """
+    # import here to prevent unnecessary dependency on TensorRT
+    from tensorflow.python.compiler.tensorrt import trt_convert as trt
+
+    graph_def, input_names, output_names = freeze_model(model, release=True)
+
+    converter = trt.TrtGraphConverter(
+        input_graph_def=graph_def,
+        nodes_blacklist=output_names,
+        max_batch_size=max_batch_size,
+        precision_mode=precision_mode,
+        is_dynamic_op=True,
+    )
+    graph_def = converter.convert()
+
+    # don't let the session reserve all GPU memory, the engines are built next to it
+    if config is None:
+        config = session_config()
+
+    return GraphModel(graph_def, input_names, output_names, config=config)
+
+
+def warmup(model, inputs, steps=2):
+    """ Run a batch through the model a few times before it is used.
+
+    The first runs of a fresh session initialize the CUDA context and let cuDNN (or TensorRT)
+    select kernels for the input shape, which otherwise shows up as stalls during evaluation.
+
+    Args
+        model  : The model to warm up, any object with a predict_on_batch method.
+        inputs : A representative batch of network inputs.
+        steps  : Number of times to run the batch.
+    """
+    for _ in range(steps):
+        model.predict_on_batch(inputs)
+
+
+def _filter_model(num_classes):
+    """ Build the box decoding and filtering part of a retinanet inference model as a separate model.
+
+    The model takes [image, anchors, regression, classification] and outputs [boxes, scores, labels].
+    """
+    image          = keras.layers.Input(shape=(None, None, 3))
+    anchors        = keras.layers.Input(shape=(None, 4))
+    regression     = keras.layers.Input(shape=(None, 4))
+    classification = keras.layers.Input(shape=(None, num_classes))
+
+    boxes      = layers.RegressBoxes(name='boxes')([anchors, regression])
+    boxes      = layers.ClipBoxes(name='clipped_boxes')([image, boxes])
+    detections = layers.FilterDetections(name='filtered_detections')([boxes, classification])
+
+    return keras.models.Model(inputs=[image, anchors, regression, classification], outputs=detections, name='retinanet-filter')
+
+
+def max_input_shape(generator):
+    """ Compute the smallest input shape that fits every resized image of a generator.
+
+    The resized shape of an image only depends on its aspect ratio, so the images don't need to be loaded.
+
+    Args
+        generator : The generator of the images.
+
+    Returns
+        A tuple (rows, cols, channels).
+    """
+    if generator.no_resize:
+        shapes = [generator.load_image(index).shape[:2] for index in range(generator.size())]
+    else:
+        shapes = []
+        for index in range(generator.size()):
+            ratio = generator.image_aspect_ratio(index)
+            scale = compute_resize_scale((1.0, ratio, 3), min_side=generator.image_min_side, max_side=generator.image_max_side)
+
+            # round up, a resized side can not exceed the maximum side
+            shapes.append([min(int(np.ceil(side)), generator.image_max_side) for side in (scale, ratio * scale)])
+
+    rows, cols = np.max(shapes, axis=0)
+    return int(rows), int(cols), 3
+
+
+class TFLiteModel:
+    """ Run an int8 tflite conversion of a retinanet training model, in place of a keras inference model for prediction.
+
+    The converted network has a fixed input shape, images are padded to it.
+    Boxes are decoded and filtered in float with the regular retinanet layers.
+
+    Args
+        model_content : The converted tflite flatbuffer, see convert_tflite_int8.
+        input_shape   : The (height, width, channels) input shape the network was converted with.
+        num_classes   : Number of classes predicted by the network.
+        anchor_params : Struct containing anchor parameters. If None, default values are used.
+    """
+    def __init__(self, model_content, input_shape, num_classes, anchor_params=None):
+        self.interpreter = tf.lite.Interpreter(model_content=model_content)
+        self.interpreter.allocate_tensors()
+
+        self.input_index    = self.interpreter.get_input_details()[0]['index']
+        self.output_indices = [output['index'] for output in self.interpreter.get_output_details()]
+        self.input_shape    = tuple(input_shape)
+        self.anchors        = np.expand_dims(anchors_for_shape(self.input_shape, anchor_params=anchor_params), axis=0)
+        self.filter_model   = _filter_model(num_classes)
+
+    def predict_on_batch(self, x):
+        """ Run the network on each image of a batch, returns [boxes, scores, labels] like an inference model.
+        """
+        regression     = []
+        classification = []
+        for image in x:
+            # pad the image to the fixed input shape of the network
+            padded = np.zeros((1,) + self.input_shape, dtype=np.float32)
+            padded[0, :image.shape[0], :image.shape[1], :] = image
+
+            self.interpreter.set_tensor(self.input_index, padded)
+            self.interpreter.invoke()
+            outputs = [self.interpreter.get_tensor(index) for index in self.output_indices]
+            regression.append(outputs[0])
+            classification.append(outputs[1])
+
+        anchors = np.repeat(self.anchors, x.shape[0], axis=0)
+        return self.filter_model.predict_on_batch([x, anchors, np.concatenate(regression), np.concatenate(classification)])
+
+
+def convert_tflite_int8(model, generator, num_samples=100, anchor_params=None):
+    """ Quantize a retinanet training model to int8 with post training quantization.
+
+    Int8 convolutions need a quarter of the memory bandwidth of float32 and use the int8 dot product
+    instructions of recent CPUs, which makes this the fastest option for evaluation without a GPU.
+
+    Args
+        model         : The retinanet training model, with regression and classification outputs.
+        generator     : The generator used to sample images for calibrating the quantization ranges.
+        num_samples   : Number of images used for calibration.
+        anchor_params : Struct containing anchor parameters. If None, default values are used.
+
+    Returns
+        A TFLiteModel running the quantized network.
+    """
+    # tflite needs a static input shape, use the smallest one that fits every image to avoid computing on padding
+    input_shape = max_input_shape(generator)
+    inputs      = keras.layers.Input(batch_shape=(1,) + input_shape)
+    outputs     = model(inputs)[:2]
+
+    def representative_dataset():
+        for index in range(min(num_samples, generator.size())):
+            image, _ = generator.resize_image(generator.preprocess_image(generator.load_image(index)))
+            padded   = np.zeros((1,) + input_shape, dtype=np.float32)
+            padded[0, :image.shape[0], :image.shape[1], :] = image
+            yield [padded]
+
+    converter = tf.lite.TFLiteConverter.from_session(keras.backend.get_session(), [inputs], outputs)
+    converter.optimizations             = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset    = tf.lite.RepresentativeDataset(representative_dataset)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    num_classes = keras.backend.int_shape(model.outputs[1])[-1]
+    return TFLiteModel(converter.convert(), input_shape, num_classes, anchor_params=anchor_params)
@@ -230,3 +230,21 @@ def test_reload_weights(release_model):
 
     # Returns a 6 column numpy array, xmin, ymin, xmax, ymax, score, label
     assert boxes.shape[1] == 6
+
+
+def test_convert_tflite_int8(release_model, annotations):
+    from deepforest.keras_retinanet.preprocessing.csv_generator import CSVGenerator
+    from deepforest.keras_retinanet.utils.inference import convert_tflite_int8, max_input_shape
+
+    classes_file = utilities.create_classes(annotations)
+    generator = CSVGenerator(annotations, classes_file, image_min_side=200, image_max_side=300, shuffle_groups=False)
+
+    # the static input shape fits the resized image without padding to the maximum side
+    image, _ = generator.resize_image(generator.preprocess_image(generator.load_image(0)))
+    assert max_input_shape(generator) == image.shape
+
+    tflite_model = convert_tflite_int8(release_model.model, generator, num_samples=1)
+    boxes, scores, labels = tflite_model.predict_on_batch(np.expand_dims(image, axis=0))
+
+    assert boxes.shape == (1, 300, 4)
+    assert scores.shape == labels.shape == (1, 300)
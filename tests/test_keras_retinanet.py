@@ -1,6 +1,7 @@
 # test loading of keras retinanet
 import os
 from deepforest.keras_retinanet.utils.anchors import compute_overlap
+from deepforest.keras_retinanet.utils.eval import _compute_ap, _match_detections, _InferenceSequence
 import numpy as np
 
 def test_keras_retinanet():
@@ -15,4 +16,239 @@ def test_iou():
     true_array = np.expand_dims(np.array([0.,0.,5.,5.]),axis=0)
     prediction_array = np.expand_dims(np.array([0.,0.,10.,10.]), axis=0)
     retinanet_iou = compute_overlap(prediction_array,true_array)
-    assert retinanet_iou[0][0] == (5**2/10**2)
\ No newline at end of file
+    assert retinanet_iou[0][0] == (5**2/10**2)
+
+def test_compute_ap():
+    recall = np.array([0.25, 0.5, 0.5, 0.75])
+    precision = np.array([1., 0.5, 2/3, 0.75])
+    # envelope is [1, 0.75, 0.75, 0.75] over recall steps of 0.25
+    assert np.isclose(_compute_ap(recall, precision), 0.25 + 0.75 * 0.5)
+
+def test_fold_batch_norms():
+    import keras
+    from deepforest.keras_retinanet.utils.inference import GraphModel, fold_batch_norms, freeze_model
+
+    inputs  = keras.layers.Input(shape=(None, None, 3))
+    x       = keras.layers.Conv2D(4, (3, 3), padding='same', use_bias=False)(inputs)
+    outputs = keras.layers.BatchNormalization(epsilon=1e-3)(x, training=False)
+    model   = keras.models.Model(inputs=inputs, outputs=outputs)
+
+    # gamma, beta, moving mean and moving variance away from their initial values
+    model.layers[-1].set_weights([
+        np.random.uniform(0.5, 2, 4),
+        np.random.uniform(-1, 1, 4),
+        np.random.uniform(-1, 1, 4),
+        np.random.uniform(0.5, 2, 4)])
+
+    images = np.random.uniform(-1, 1, (2, 8, 8, 3)).astype(np.float32)
+    expected = model.predict(images)
+
+    graph_def, input_names, output_names = freeze_model(model)
+    folded = fold_batch_norms(graph_def)
+    assert not [node.name for node in folded.node if node.op.startswith('FusedBatchNorm')]
+
+    result = GraphModel(folded, input_names, output_names).predict_on_batch(images)[0]
+    np.testing.assert_allclose(result, expected, rtol=1e-4, atol=1e-4)
+
+def _reference_match(detections, annotations, iou_threshold):
+    # one detection at a time, as in the original keras-retinanet evaluation
+    true_positives = []
+    detected_annotations = []
+    for d in detections:
+        if annotations.shape[0] == 0:
+            true_positives.append(0)
+            continue
+        overlaps = compute_overlap(np.expand_dims(d[:4], axis=0).astype(np.float64), annotations.astype(np.float64))
+        assigned_annotation = np.argmax(overlaps, axis=1)[0]
+        if overlaps[0, assigned_annotation] >= iou_threshold and assigned_annotation not in detected_annotations:
+            true_positives.append(1)
+            detected_annotations.append(assigned_annotation)
+        else:
+            true_positives.append(0)
+    return np.array(true_positives, dtype=np.float64)
+
+def test_match_detections():
+    annotations = np.array([[0., 0., 10., 10.], [20., 20., 30., 30.], [8., 0., 18., 10.]])
+    # sorted by score: a duplicate of the first annotation, a box overlapping two annotations, a miss
+    detections = np.array([
+        [0., 0., 10., 10., 0.9],
+        [1., 0., 11., 10., 0.8],
+        [6., 0., 16., 10., 0.7],
+        [20., 20., 29., 30., 0.6],
+        [50., 50., 60., 60., 0.5],
+        [21., 21., 30., 30., 0.4]])
+
+    cases = [
+        (detections, annotations),
+        (detections, np.zeros((0, 4))),
+        (np.zeros((0, 5)), annotations),
+        (np.zeros((0, 5)), np.zeros((0, 4)))]
+
+    for image_detections, image_annotations in cases:
+        expected = _reference_match(image_detections, image_annotations, 0.5)
+        np.testing.assert_array_equal(_match_detections(image_detections, image_annotations, 0.5), expected)
+
+    # the duplicate and the second match of the last annotation are false positives
+    np.testing.assert_array_equal(_match_detections(detections, annotations, 0.5), [1, 0, 1, 1, 0, 0])
+
+def test_annotations_cache(tmpdir, monkeypatch):
+    from deepforest.keras_retinanet.preprocessing import csv_generator
+
+    cache_dir = str(tmpdir.join("cache"))
+    parsed = csv_generator.CSVGenerator("tests/data/testfile_tfrecords.csv", "tests/data/classes.csv", annotations_cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # the second generator has to load the cache instead of parsing
+    def fail(*args, **kwargs):
+        raise AssertionError("annotations were parsed again")
+    monkeypatch.setattr(csv_generator, "_read_annotations", fail)
+
+    cached = csv_generator.CSVGenerator("tests/data/testfile_tfrecords.csv", "tests/data/classes.csv", annotations_cache_dir=cache_dir)
+    assert cached.image_data == parsed.image_data
+    assert cached.image_names == parsed.image_names
+
+    # a truncated cache is a cache miss
+    monkeypatch.undo()
+    cache_path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+    with open(cache_path, "rb") as file:
+        content = file.read()
+    with open(cache_path, "wb") as file:
+        file.write(content[:len(content) // 2])
+
+    reparsed = csv_generator.CSVGenerator("tests/data/testfile_tfrecords.csv", "tests/data/classes.csv", annotations_cache_dir=cache_dir)
+    assert reparsed.image_data == parsed.image_data
+
+def test_image_cache(tmpdir, monkeypatch):
+    from deepforest.keras_retinanet.preprocessing import csv_generator
+
+    names = ["a.png", "b.png", "c.png", "large.png"]
+    for name in names:
+        tmpdir.join(name).write("")
+    annotations_file = tmpdir.join("annotations.csv")
+    annotations_file.write("".join("{},,,,,\n".format(name) for name in names))
+
+    reads = []
+    def read_image_bgr(path):
+        reads.append(os.path.basename(path))
+        size = 4 if path.endswith("large.png") else 2
+        return np.zeros((size, size, 3), dtype=np.uint8)
+    monkeypatch.setattr(csv_generator, "read_image_bgr", read_image_bgr)
+
+    # room for two of the small 12 byte images
+    generator = csv_generator.CSVGenerator(str(annotations_file), "tests/data/classes.csv", image_cache_bytes=24)
+
+    # cached images are returned as copies
+    image = generator.load_image(0)
+    image[:] = 255
+    assert generator.load_image(0).max() == 0
+    assert reads == ["a.png"]
+
+    # the least recently used image is evicted
+    generator.load_image(1)
+    generator.load_image(0)
+    generator.load_image(2)
+    assert reads == ["a.png", "b.png", "c.png"]
+    generator.load_image(0)
+    generator.load_image(1)
+    assert reads == ["a.png", "b.png", "c.png", "b.png"]
+    assert generator.image_cache_used == 24
+
+    # images larger than the cache are never cached
+    generator.load_image(3)
+    generator.load_image(3)
+    assert reads[-2:] == ["large.png", "large.png"]
+    assert generator.image_cache_used == 24
+
+def test_combined_filter_detections():
+    import keras
+    from deepforest.keras_retinanet.layers import FilterDetections
+
+    boxes = np.array([
+        [[0., 0., 50., 50.], [5., 5., 55., 55.], [60., 60., 90., 90.], [0., 0., 100., 100.]],
+        [[10., 10., 20., 20.], [0., 0., 1., 1.], [0., 0., 1., 1.], [0., 0., 1., 1.]]], dtype=np.float32)
+    classification = np.array([
+        [[0.9, 0.1], [0.8, 0.05], [0.7, 0.6], [0.05, 0.3]],
+        [[0.5, 0.1], [0.1, 0.1], [0.1, 0.1], [0.1, 0.1]]], dtype=np.float32)
+    inputs = [keras.backend.constant(boxes), keras.backend.constant(classification)]
+
+    parameters = dict(nms_threshold=0.5, score_threshold=0.2, max_detections=10)
+    expected = keras.backend.batch_get_value(FilterDetections(**parameters)(inputs))
+    combined = keras.backend.batch_get_value(FilterDetections(combined_nms=True, **parameters)(inputs))
+
+    # the second box of the first image is suppressed, boxes with a score below the threshold are dropped
+    valid_detections = [4, 1]
+    for image_index, valid in enumerate(valid_detections):
+        for expected_output, combined_output in zip(expected, combined):
+            np.testing.assert_allclose(combined_output[image_index, :valid], expected_output[image_index, :valid], atol=1e-4)
+
+            # padded with -1 past the valid detections
+            assert (combined_output[image_index, valid:] == -1).all()
+
+def _image_generator(tmpdir, shapes, **kwargs):
+    # a csv generator over random images of the given (rows, cols) shapes, without annotations
+    from PIL import Image
+    from deepforest.keras_retinanet.preprocessing.csv_generator import CSVGenerator
+
+    random = np.random.RandomState(0)
+    names = []
+    for index, (rows, cols) in enumerate(shapes):
+        name = "image_{}.png".format(index)
+        Image.fromarray(random.randint(0, 256, (rows, cols, 3)).astype(np.uint8)).save(str(tmpdir.join(name)))
+        names.append(name)
+
+    annotations_file = tmpdir.join("annotations.csv")
+    annotations_file.write("".join("{},,,,,\n".format(name) for name in names))
+
+    return CSVGenerator(str(annotations_file), "tests/data/classes.csv", image_min_side=32, image_max_side=64, shuffle_groups=False, **kwargs)
+
+def test_fused_inputs(tmpdir):
+    from deepforest.keras_retinanet.utils.image import preprocess_image
+
+    generator = _image_generator(tmpdir, [(30, 40), (50, 20)], batch_size=2)
+    sequence = _InferenceSequence(generator)
+    raw_images = generator.load_image_group(sequence.groups[0])
+    fused_inputs, fused_scales, fused_shapes = sequence._fused_inputs(raw_images)
+
+    # a different preprocessing function forces the generic preprocess, resize and pad path
+    generator.preprocess_image = lambda x: preprocess_image(x)
+    _, _, inputs, scales, shapes = sequence[0]
+
+    assert fused_scales == scales
+    assert fused_shapes == shapes
+    np.testing.assert_allclose(fused_inputs, inputs, atol=1e-3)
+
+class _PaddingModel:
+    # predicts a box covering the whole padded input and a fixed box for every image
+    def __init__(self):
+        self.images = 0
+
+    def predict_on_batch(self, inputs):
+        self.images += inputs.shape[0]
+        rows, cols = inputs.shape[1:3]
+        boxes = np.repeat([[[0., 0., cols, rows], [1., 2., 5., 6.]]], inputs.shape[0], axis=0)
+        scores = np.repeat([[0.9, 0.8]], inputs.shape[0], axis=0)
+        labels = np.zeros(scores.shape, dtype=np.int32)
+        return boxes, scores, labels
+
+def test_get_detections_batched(tmpdir):
+    from deepforest.keras_retinanet.utils.eval import _get_detections
+
+    # mixed shapes and a size that is not a multiple of the batch size
+    shapes = [(30, 40), (50, 20), (32, 32), (20, 60), (45, 45)]
+
+    detections = []
+    for batch_size, workers in [(1, 0), (3, 1)]:
+        generator = _image_generator(tmpdir, shapes, batch_size=batch_size, group_method="ratio")
+        model = _PaddingModel()
+        detections.append(_get_detections(generator, model, workers=workers))
+
+        # every image runs through the network once, without padding rows
+        assert model.images == len(shapes)
+
+    for single, batched in zip(*detections):
+        for single_label, batched_label in zip(single, batched):
+            np.testing.assert_allclose(batched_label, single_label, atol=1e-4)
+
+    # boxes reaching into the padding are clipped to the image itself
+    for image_detections, (rows, cols) in zip(detections[1], shapes):
+        np.testing.assert_allclose(image_detections[0][0, :4], [0, 0, cols, rows], atol=1)